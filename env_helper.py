@@ -1,8 +1,23 @@
 import os
 import json
 import base64
+from functools import lru_cache
 from google.oauth2 import service_account
-from googleapiclient.discovery import build
+from gsc_client import SearchConsoleClient
+
+@lru_cache(maxsize=1)
+def _credentials_from_key(encoded_key):
+    """Decodifica la chiave e crea le credenziali una sola volta per valore della variabile"""
+    # Decodifica da base64
+    service_account_info = json.loads(
+        base64.b64decode(encoded_key).decode('utf-8')
+    )
+
+    # Crea credenziali
+    return service_account.Credentials.from_service_account_info(
+        service_account_info,
+        scopes=['https://www.googleapis.com/auth/webmasters']
+    )
 
 def get_google_credentials():
     """Recupera credenziali Google dalle variabili d'ambiente"""
@@ -10,26 +25,23 @@ def get_google_credentials():
         encoded_key = os.getenv('GOOGLE_SERVICE_ACCOUNT_KEY')
         if not encoded_key:
             raise Exception("GOOGLE_SERVICE_ACCOUNT_KEY mancante")
-        
-        # Decodifica da base64
-        service_account_info = json.loads(
-            base64.b64decode(encoded_key).decode('utf-8')
-        )
-        
-        # Crea credenziali
-        credentials = service_account.Credentials.from_service_account_info(
-            service_account_info,
-            scopes=['https://www.googleapis.com/auth/webmasters']
-        )
-        
-        return credentials
+
+        # Stesso oggetto condiviso: il token viene rinnovato in place dal client
+        return _credentials_from_key(encoded_key)
         
     except Exception as e:
         print(f"Errore credenziali: {e}")
         raise e
 
+@lru_cache(maxsize=1)
 def get_search_console_service():
-    """Crea servizio Google Search Console"""
+    """Crea servizio Google Search Console (una sola istanza per processo)"""
     credentials = get_google_credentials()
-    service = build('searchconsole', 'v1', credentials=credentials)
-    return service
+
+    # Client REST asincrono: una sola sessione aiohttp con pool di connessioni
+    # keep-alive verso searchconsole.googleapis.com
+    return SearchConsoleClient(
+        credentials,
+        token_cache_path=os.getenv('GSC_TOKEN_CACHE'),
+        pool_size=int(os.getenv('GSC_POOL_SIZE', '100'))
+    )
@@ -0,0 +1,174 @@
+import asyncio
+import json
+import logging
+import os
+import tempfile
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+from urllib.parse import quote
+import aiohttp
+import orjson
+from google.auth import _helpers
+from google.auth.transport.requests import Request as AuthRequest
+
+try:
+    import fcntl
+except ImportError:  # Windows: nessun token condiviso tra processi
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+BASE_URL = "https://searchconsole.googleapis.com/webmasters/v3"
+
+# Rinnovo anticipato del token rispetto alla scadenza
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+
+class GSCHttpError(Exception):
+    """Errore HTTP restituito dalle API Search Console"""
+
+    def __init__(self, status: int, message: str, retry_after: Optional[str] = None):
+        super().__init__(f"HTTP {status}: {message}")
+        self.status = status
+        self.retry_after = retry_after
+
+class TokenFileCache:
+    """Access token condiviso tra i worker tramite file protetto da fcntl.flock"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def refresh(self, credentials, margin: timedelta, auth_request: AuthRequest):
+        """Riusa il token su file se ancora valido, altrimenti lo rinnova e lo salva"""
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        with os.fdopen(fd, 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                identity = {
+                    'service_account_email': getattr(credentials, 'service_account_email', None),
+                    'scopes': sorted(getattr(credentials, 'scopes', None) or [])
+                }
+                try:
+                    cached = json.loads(f.read() or '{}')
+                    token = cached['token']
+                    expiry = datetime.fromisoformat(cached['expiry'])
+                    # Token di un altro account o con altri scope: va ignorato
+                    if {k: cached.get(k) for k in identity} != identity:
+                        token, expiry = None, None
+                except (KeyError, TypeError, ValueError):
+                    token, expiry = None, None
+
+                if token and expiry - _helpers.utcnow() > margin:
+                    credentials.token = token
+                    credentials.expiry = expiry
+                    return
+
+                credentials.refresh(auth_request)
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps({
+                    **identity,
+                    'token': credentials.token,
+                    'expiry': credentials.expiry.isoformat()
+                }))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+class SearchConsoleClient:
+    """Client REST asincrono per Google Search Console (aiohttp + google-auth)"""
+
+    def __init__(self, credentials, token_cache_path: Optional[str] = None,
+                 pool_size: int = 100):
+        self.credentials = credentials
+        self.pool_size = pool_size
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._token_lock = asyncio.Lock()
+        # Una sola sessione requests per i rinnovi del token: connessione a oauth2 riusata
+        self._auth_request = AuthRequest()
+        self._token_cache = None
+        if fcntl is not None:
+            self._token_cache = TokenFileCache(
+                token_cache_path or os.path.join(tempfile.gettempdir(), 'gsc.token')
+            )
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Sessione condivisa con pool di connessioni keep-alive, creata al primo uso"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                # Tutte le chiamate vanno allo stesso host: il limite per host è il pool effettivo
+                connector=aiohttp.TCPConnector(
+                    limit=self.pool_size,
+                    limit_per_host=self.pool_size,
+                    ttl_dns_cache=300
+                ),
+                timeout=aiohttp.ClientTimeout(total=60)
+            )
+        return self._session
+
+    def _refresh_token(self, margin: timedelta = TOKEN_REFRESH_MARGIN):
+        if self._token_cache is not None:
+            try:
+                self._token_cache.refresh(self.credentials, margin, self._auth_request)
+                return
+            except OSError as e:
+                logger.warning(f"Cache token su file non disponibile, rinnovo in memoria: {e}")
+        self.credentials.refresh(self._auth_request)
+
+    def _token_expiring(self, margin: timedelta) -> bool:
+        expiry = self.credentials.expiry
+        return not self.credentials.token or expiry is None or expiry - _helpers.utcnow() <= margin
+
+    async def keep_token_fresh(self, interval: float = 60):
+        """Task di background: rinnova il token 5 minuti prima della scadenza"""
+        while True:
+            try:
+                if self._token_expiring(TOKEN_REFRESH_MARGIN):
+                    async with self._token_lock:
+                        if self._token_expiring(TOKEN_REFRESH_MARGIN):
+                            await asyncio.to_thread(self._refresh_token)
+            except Exception as e:
+                logger.error(f"Errore rinnovo token GSC: {e}")
+            await asyncio.sleep(interval)
+
+    async def _get_token(self) -> str:
+        """Restituisce un access token valido; il rinnovo qui è solo di riserva"""
+        if not self.credentials.valid:
+            async with self._token_lock:
+                if not self.credentials.valid:
+                    await asyncio.to_thread(self._refresh_token)
+        return self.credentials.token
+
+    async def request(self, method: str, path: str, body: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Esegue una chiamata REST e restituisce il JSON di risposta"""
+        headers = {"Authorization": f"Bearer {await self._get_token()}"}
+        data = None
+        if body is not None:
+            headers["Content-Type"] = "application/json"
+            data = orjson.dumps(body)
+        async with self._get_session().request(
+            method, BASE_URL + path, data=data, headers=headers
+        ) as resp:
+            if resp.status >= 400:
+                raise GSCHttpError(
+                    resp.status,
+                    await resp.text(),
+                    resp.headers.get("Retry-After")
+                )
+            return orjson.loads(await resp.read())
+
+    async def list_sites(self) -> Dict[str, Any]:
+        return await self.request("GET", "/sites")
+
+    async def get_site(self, site_url: str) -> Dict[str, Any]:
+        return await self.request("GET", f"/sites/{quote(site_url, safe='')}")
+
+    async def query_search_analytics(self, site_url: str, body: Dict[str, Any]) -> Dict[str, Any]:
+        return await self.request(
+            "POST", f"/sites/{quote(site_url, safe='')}/searchAnalytics/query", body
+        )
+
+    async def close(self):
+        """Chiude la sessione HTTP e rilascia il pool di connessioni"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._auth_request.session.close()
@@ -1,18 +1,34 @@
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
-from pydantic import BaseModel
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import StreamingResponse, JSONResponse, ORJSONResponse, Response
+from pydantic import AfterValidator, BaseModel, Field, ValidationError, field_validator, model_validator
 import os
+import re
 import uvicorn
-import json
 import logging
 import asyncio
-from typing import Any, Dict, Optional, AsyncGenerator
+import collections
+import time
+import contextlib
+from typing import Annotated, Any, Dict, List, Optional, AsyncGenerator, Union
 import uuid
+from datetime import date, datetime, timezone
+import orjson
+from cachetools import TTLCache
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
+from gsc_client import GSCHttpError
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
 
-app = FastAPI(title="GSC MCP Server", version="1.0.0")
+app = FastAPI(
+    title="GSC MCP Server",
+    version="1.0.0",
+    default_response_class=ORJSONResponse
+)
 
 # Configurazione CORS - importante per n8n
+# (il middleware passa oltre subito se la richiesta non ha header Origin)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -21,21 +37,249 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Route che restituiscono stream SSE: la compressione gzip a blocchi romperebbe gli eventi
+_STREAM_ROUTES = {("GET", "/sse"), ("POST", "/sse/tools/call")}
+
+class SSEAwareGZipMiddleware(GZipMiddleware):
+    """GZip per le risposte JSON, lasciando passare non compressi gli stream SSE"""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and (scope["method"], scope["path"]) in _STREAM_ROUTES:
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+# Compressione delle risposte grandi (es. tools/call con molte righe analytics)
+app.add_middleware(SSEAwareGZipMiddleware, minimum_size=1024)
+
 # Configurazione logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Inizializza GSC service
-gsc_service = None
-gsc_error = None
+from env_helper import get_search_console_service
+
+# GSC service inizializzato all'avvio di ogni worker
+app.state.gsc = None
+app.state.gsc_error = None
+app.state.redis = None
+
+@app.on_event("startup")
+async def _init_redis():
+    """Collega la cache Redis condivisa tra repliche, se REDIS_URL è configurato"""
+    redis_url = os.getenv("REDIS_URL")
+    if redis_url:
+        # Timeout brevi: un Redis irraggiungibile non deve bloccare le chiamate ai tool
+        timeout = float(os.getenv("REDIS_TIMEOUT", "0.5"))
+        app.state.redis = aioredis.Redis.from_url(
+            redis_url,
+            socket_connect_timeout=timeout,
+            socket_timeout=timeout
+        )
+        logger.info("✅ Cache Redis configurata")
+
+@app.on_event("shutdown")
+async def _close_redis():
+    if app.state.redis is not None:
+        await app.state.redis.aclose()
+
+@app.on_event("startup")
+async def _init_gsc():
+    """Inizializza il GSC service senza bloccare l'import del modulo"""
+    try:
+        app.state.gsc = await asyncio.to_thread(get_search_console_service)
+        app.state.token_task = asyncio.create_task(app.state.gsc.keep_token_fresh())
+        logger.info("✅ Google Search Console service inizializzato")
+    except Exception as e:
+        app.state.gsc_error = str(e)
+        logger.error(f"❌ Errore GSC service: {e}")
+
+@app.on_event("shutdown")
+async def _close_gsc():
+    """Chiude il pool di connessioni verso Google"""
+    token_task = getattr(app.state, 'token_task', None)
+    if token_task is not None:
+        token_task.cancel()
+    if app.state.gsc is not None:
+        await app.state.gsc.close()
+
+class RPMLimiter:
+    """Limitatore a finestra scorrevole: al massimo `rpm` richieste negli ultimi 60 secondi"""
+
+    def __init__(self, rpm: int):
+        self.rpm = rpm
+        self.ts = collections.deque()
+        self.lock = asyncio.Lock()
 
-try:
-    from env_helper import get_search_console_service
-    gsc_service = get_search_console_service()
-    logger.info("✅ Google Search Console service inizializzato")
-except Exception as e:
-    gsc_error = str(e)
-    logger.error(f"❌ Errore GSC service: {e}")
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                while self.ts and now - self.ts[0] >= 60:
+                    self.ts.popleft()
+                if len(self.ts) < self.rpm:
+                    break
+                await asyncio.sleep(60 - (now - self.ts[0]))
+            self.ts.append(time.monotonic())
+
+# I limitatori vivono in ogni processo: la quota per minuto, unica vera quota globale, va divisa tra i worker
+_WORKERS = max(1, int(os.getenv("GSC_WORKERS", os.getenv("WEB_CONCURRENCY", "1"))))
+
+# Quota per minuto verso Google (GSC_RPM_LIMIT è il totale del server), applicata prima di ogni chiamata
+_GSC_LIMITER = RPMLimiter(max(1, int(os.getenv("GSC_RPM_LIMIT", "1200")) // _WORKERS))
+
+class AIMDLimiter:
+    """Concorrenza adattiva AIMD: +alpha se la latenza media resta sotto target, *beta su 429/5xx"""
+
+    def __init__(self, initial: float = 4, minimum: float = 1, maximum: float = 32,
+                 target_latency: float = 1.0, alpha: float = 0.5, beta: float = 0.5,
+                 window: int = 20):
+        self.limit = float(min(initial, maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.alpha = alpha
+        self.beta = beta
+        self.inflight = 0
+        self.latencies = collections.deque(maxlen=window)
+        self._waiters = collections.deque()
+
+    async def acquire(self):
+        while self.inflight >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # Svegliato e poi cancellato: passa il posto al prossimo in coda
+                if waiter.done() and not waiter.cancelled():
+                    self._wake_waiters()
+                raise
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self.inflight += 1
+
+    def release(self, latency: Optional[float] = None, overloaded: bool = False):
+        self.inflight -= 1
+        if overloaded:
+            self.limit = max(self.minimum, self.limit * self.beta)
+        elif latency is not None:
+            self.latencies.append(latency)
+            if sum(self.latencies) / len(self.latencies) <= self.target_latency:
+                self.limit = min(self.maximum, self.limit + self.alpha)
+        self._wake_waiters()
+
+    def _wake_waiters(self):
+        free = int(self.limit) - self.inflight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+# Limite adattivo alle chiamate Google contemporanee, per worker (ognuno ha il proprio pool di connessioni)
+_GSC_CONCURRENCY = AIMDLimiter(
+    maximum=int(os.getenv("GSC_CONCURRENCY", "32")),
+    target_latency=float(os.getenv("GSC_TARGET_LATENCY", "1.0"))
+)
+
+# Errori Google transitori da ritentare
+_RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+_MAX_BACKOFF = 30
+_backoff = wait_random_exponential(multiplier=1, max=_MAX_BACKOFF)
+
+def _is_retryable(exc: BaseException) -> bool:
+    return isinstance(exc, GSCHttpError) and exc.status in _RETRYABLE_STATUS
+
+def _wait_retry_after(retry_state) -> float:
+    """Backoff esponenziale con jitter, rispettando l'header Retry-After se presente (max 30s)"""
+    delay = _backoff(retry_state)
+    exc = retry_state.outcome.exception()
+    try:
+        return min(_MAX_BACKOFF, max(delay, float(exc.retry_after)))
+    except (AttributeError, TypeError, ValueError):
+        return delay
+
+@retry(
+    retry=retry_if_exception(_is_retryable),
+    wait=_wait_retry_after,
+    stop=stop_after_attempt(5),
+    reraise=True
+)
+async def _run(call, *args):
+    """Esegue una chiamata asincrona al client GSC rispettando quota, concorrenza e retry"""
+    await _GSC_LIMITER.acquire()
+    await _GSC_CONCURRENCY.acquire()
+    start = time.monotonic()
+    try:
+        result = await call(*args)
+    except Exception as e:
+        _GSC_CONCURRENCY.release(overloaded=_is_retryable(e))
+        raise
+    except BaseException:
+        _GSC_CONCURRENCY.release()
+        raise
+    _GSC_CONCURRENCY.release(latency=time.monotonic() - start)
+    return result
+
+# Cache in-process per le chiamate di sola lettura (proprietà, dettagli sito)
+_CACHE = TTLCache(maxsize=2048, ttl=int(os.getenv("GSC_CACHE_TTL", "300")))
+_MISSING = object()
+
+class _KeyLock:
+    """Lock per chiave con il conteggio di chi lo usa, per rimuoverlo solo quando è libero"""
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+_CACHE_LOCKS: Dict[tuple, _KeyLock] = {}
+
+async def _cached(key: tuple, fetch):
+    """Restituisce il valore in cache o lo calcola una sola volta per chiave (single-flight)"""
+    value = _CACHE.get(key, _MISSING)
+    if value is not _MISSING:
+        return value
+
+    entry = _CACHE_LOCKS.get(key)
+    if entry is None:
+        entry = _CACHE_LOCKS[key] = _KeyLock()
+    entry.users += 1
+    try:
+        async with entry.lock:
+            value = _CACHE.get(key, _MISSING)
+            if value is _MISSING:
+                value = await fetch()
+                _CACHE[key] = value
+            return value
+    finally:
+        # Anche dopo un errore il lock resta finché qualcuno è in coda su di esso
+        entry.users -= 1
+        if entry.users == 0 and _CACHE_LOCKS.get(key) is entry:
+            del _CACHE_LOCKS[key]
+
+# Cache Redis (cache-aside) per i risultati searchAnalytics: i dati GSC si aggiornano giornalmente
+_ANALYTICS_TTL = int(os.getenv("GSC_ANALYTICS_TTL", "3600"))
+
+async def _redis_cached(key: str, fetch, ttl: int):
+    """Legge il valore da Redis o lo calcola e lo salva; senza Redis chiama solo fetch"""
+    redis = app.state.redis
+    if redis is None:
+        return await fetch()
+
+    try:
+        cached = await redis.get(key)
+        if cached is not None:
+            return orjson.loads(cached)
+    except RedisError as e:
+        logger.warning(f"Errore lettura cache Redis: {e}")
+
+    value = await fetch()
+    try:
+        await redis.set(key, orjson.dumps(value), ex=ttl)
+    except RedisError as e:
+        logger.warning(f"Errore scrittura cache Redis: {e}")
+    return value
 
 # Definizione dei tool MCP
 TOOLS_DEFINITION = [
@@ -65,6 +309,10 @@ TOOLS_DEFINITION = [
                 "end_date": {
                     "type": "string",
                     "description": "Data di fine in formato YYYY-MM-DD (default: oggi)"
+                },
+                "max_rows": {
+                    "type": "integer",
+                    "description": "Numero massimo di righe da scaricare, paginando oltre 25000 (default: 25)"
                 }
             },
             "required": ["site_url"]
@@ -83,81 +331,257 @@ TOOLS_DEFINITION = [
             },
             "required": ["site_url"]
         }
+    },
+    {
+        "name": "batch_site_details",
+        "description": "Ottieni i dettagli di più siti in parallelo",
+        "inputSchema": {
+            "type": "object",
+            "properties": {
+                "site_urls": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "Lista di URL completi dei siti"
+                }
+            },
+            "required": ["site_urls"]
+        }
     }
 ]
 
-def execute_tool(tool_name: str, arguments: Dict[str, Any]) -> Dict[str, Any]:
-    """Esegue un tool specifico"""
-    try:
-        if not gsc_service:
-            raise Exception(f"GSC service non disponibile: {gsc_error}")
+# Validazione dei parametri dei tool, prima di spendere una chiamata a Google
+_SITE_URL_RE = re.compile(r"^(https?://\S+|sc-domain:\S+)$")
+_DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
 
-        if tool_name == "list_properties":
-            sites = gsc_service.sites().list().execute()
-            properties = [site['siteUrl'] for site in sites.get('siteEntry', [])]
-            return {
-                "success": True,
-                "properties": properties,
-                "count": len(properties)
-            }
+def _check_site_url(value: str) -> str:
+    if not _SITE_URL_RE.match(value):
+        raise ValueError("site_url deve essere un URL http(s) o una proprietà sc-domain:")
+    return value
 
-        elif tool_name == "get_search_analytics":
-            site_url = arguments.get('site_url')
-            start_date = arguments.get('start_date', '2024-05-01')
-            end_date = arguments.get('end_date', '2024-06-09')
+SiteUrl = Annotated[str, AfterValidator(_check_site_url)]
 
-            if not site_url:
-                raise ValueError("site_url è richiesto")
+class SiteParams(BaseModel):
+    site_url: SiteUrl
 
-            search_request = {
-                'startDate': start_date,
-                'endDate': end_date,
-                'dimensions': ['query'],
-                'rowLimit': 25
-            }
+class BatchSiteParams(BaseModel):
+    site_urls: List[SiteUrl] = Field(min_length=1)
 
-            response = gsc_service.searchanalytics().query(
-                siteUrl=site_url, body=search_request
-            ).execute()
+class SearchAnalyticsParams(SiteParams):
+    start_date: date = date(2024, 5, 1)
+    end_date: date = date(2024, 6, 9)
+    max_rows: int = Field(25, ge=1)
 
-            analytics_data = response.get('rows', [])
-            
-            return {
-                "success": True,
-                "site_url": site_url,
-                "period": f"{start_date} to {end_date}",
-                "total_queries": len(analytics_data),
-                "top_queries": analytics_data[:10],
-                "summary": {
-                    "total_clicks": sum(row.get('clicks', 0) for row in analytics_data),
-                    "total_impressions": sum(row.get('impressions', 0) for row in analytics_data)
-                }
-            }
+    @field_validator('start_date', 'end_date', mode='before')
+    @classmethod
+    def _check_date_format(cls, value):
+        if isinstance(value, str) and not _DATE_RE.match(value):
+            raise ValueError("la data deve essere in formato YYYY-MM-DD")
+        return value
 
-        elif tool_name == "get_site_details":
-            site_url = arguments.get('site_url')
-            if not site_url:
-                raise ValueError("site_url è richiesto")
+    @model_validator(mode='after')
+    def _check_period(self):
+        if self.start_date > self.end_date:
+            raise ValueError("start_date deve precedere end_date")
+        return self
 
-            site_info = gsc_service.sites().get(siteUrl=site_url).execute()
-            return {
-                "success": True,
-                "site_url": site_url,
-                "verification_method": site_info.get('verificationMethod'),
-                "permission_level": site_info.get('permissionLevel'),
-                "verified": site_info.get('verified', False)
+# orjson serializza solo interi a 64 bit: id numerici fuori range vanno rifiutati
+_ID_MIN, _ID_MAX = -2**63, 2**64 - 1
+MessageId = Union[str, Annotated[int, Field(ge=_ID_MIN, le=_ID_MAX)], None]
+
+class MCPMessage(BaseModel):
+    """Messaggio JSON-RPC ricevuto via POST dai client MCP"""
+    model_config = {"extra": "allow"}
+
+    jsonrpc: str = "2.0"
+    method: str
+    params: Optional[Dict[str, Any]] = Field(default_factory=dict)
+    id: MessageId = "1"
+
+    @field_validator('params', mode='before')
+    @classmethod
+    def _null_params(cls, value):
+        # "params": null è ammesso da alcuni client JSON-RPC: vale come nessun parametro
+        return {} if value is None else value
+
+def _format_site_details(site_url: str, site_info: Dict[str, Any]) -> Dict[str, Any]:
+    """Estrae i campi di interesse dalla risposta sites.get"""
+    return {
+        "site_url": site_url,
+        "verification_method": site_info.get('verificationMethod'),
+        "permission_level": site_info.get('permissionLevel'),
+        "verified": site_info.get('verified', False)
+    }
+
+async def get_properties(gsc_service) -> List[str]:
+    """Lista delle proprietà GSC, condivisa tramite cache da tool ed endpoint"""
+    async def fetch_properties():
+        sites = await _run(gsc_service.list_sites)
+        return [site['siteUrl'] for site in sites.get('siteEntry', [])]
+
+    return await _cached(("list_properties",), fetch_properties)
+
+async def _tool_list_properties(gsc_service, arguments: Dict[str, Any]) -> Dict[str, Any]:
+    properties = await get_properties(gsc_service)
+    return {
+        "success": True,
+        "properties": properties,
+        "count": len(properties)
+    }
+
+# Limite di righe per singola pagina imposto dall'API searchAnalytics
+_MAX_PAGE_ROWS = 25000
+
+async def _iter_search_analytics(gsc_service, site_url: str, start_date: str,
+                                 end_date: str, max_rows: int):
+    """Scarica le righe searchAnalytics pagina per pagina (startRow), fino a max_rows"""
+    base_body = {
+        'startDate': start_date,
+        'endDate': end_date,
+        'dimensions': ['query']
+    }
+    start_row = 0
+    while start_row < max_rows:
+        page_size = min(_MAX_PAGE_ROWS, max_rows - start_row)
+        page = await _run(
+            gsc_service.query_search_analytics,
+            site_url,
+            {**base_body, 'rowLimit': page_size, 'startRow': start_row}
+        )
+        rows = page.get('rows', [])
+        if rows:
+            yield rows
+        if len(rows) < page_size:
+            return
+        start_row += page_size
+
+class _AnalyticsSummary:
+    """Aggregazione searchAnalytics in un solo passaggio, pagina per pagina: delle righe
+    si conservano solo le prime 10, le sole restituite nel risultato"""
+
+    def __init__(self, site_url: str, start_date: str, end_date: str):
+        self.site_url = site_url
+        self.period = f"{start_date} to {end_date}"
+        self.top_queries = []
+        self.total_queries = 0
+        self.total_clicks = 0
+        self.total_impressions = 0
+
+    def add_page(self, rows: List[Dict[str, Any]]):
+        if len(self.top_queries) < 10:
+            self.top_queries.extend(rows[:10 - len(self.top_queries)])
+        self.total_queries += len(rows)
+        for row in rows:
+            self.total_clicks += row.get('clicks', 0)
+            self.total_impressions += row.get('impressions', 0)
+
+    def result(self) -> Dict[str, Any]:
+        return {
+            "success": True,
+            "site_url": self.site_url,
+            "period": self.period,
+            "total_queries": self.total_queries,
+            "top_queries": self.top_queries,
+            "summary": {
+                "total_clicks": self.total_clicks,
+                "total_impressions": self.total_impressions
             }
+        }
+
+async def _tool_search_analytics(gsc_service, arguments: Dict[str, Any]) -> Dict[str, Any]:
+    params = SearchAnalyticsParams.model_validate(arguments)
+    site_url = params.site_url
+    start_date = params.start_date.isoformat()
+    end_date = params.end_date.isoformat()
 
+    async def fetch_analytics():
+        summary = _AnalyticsSummary(site_url, start_date, end_date)
+        async for rows in _iter_search_analytics(
+            gsc_service, site_url, start_date, end_date, params.max_rows
+        ):
+            summary.add_page(rows)
+        return summary.result()
+
+    key = f"gsc:sa:{site_url}:{start_date}:{end_date}:{params.max_rows}"
+    return await _redis_cached(key, fetch_analytics, _ANALYTICS_TTL)
+
+async def _site_details(gsc_service, site_url: str) -> Dict[str, Any]:
+    """Dettagli di un sito dalla cache condivisa tra get_site_details e batch_site_details"""
+    async def fetch_details():
+        site_info = await _run(gsc_service.get_site, site_url)
+        return _format_site_details(site_url, site_info)
+
+    return await _cached(("get_site_details", site_url), fetch_details)
+
+async def _tool_site_details(gsc_service, arguments: Dict[str, Any]) -> Dict[str, Any]:
+    site_url = SiteParams.model_validate(arguments).site_url
+
+    details = await _site_details(gsc_service, site_url)
+    return {
+        "success": True,
+        **details
+    }
+
+async def _tool_batch_site_details(gsc_service, arguments: Dict[str, Any]) -> Dict[str, Any]:
+    site_urls = BatchSiteParams.model_validate(arguments).site_urls
+
+    # Richieste concorrenti sulla stessa sessione keep-alive; i siti già in cache non chiamano Google
+    urls = list(dict.fromkeys(site_urls))
+    responses = await asyncio.gather(
+        *(_site_details(gsc_service, url) for url in urls),
+        return_exceptions=True
+    )
+
+    sites = {}
+    errors = {}
+    for url, response in zip(urls, responses):
+        if isinstance(response, Exception):
+            errors[url] = str(response)
         else:
+            sites[url] = response
+
+    return {
+        "success": not errors,
+        "sites": sites,
+        "errors": errors,
+        "count": len(sites)
+    }
+
+# Dispatch dei tool: nome -> handler
+_TOOL_HANDLERS = {
+    "list_properties": _tool_list_properties,
+    "get_search_analytics": _tool_search_analytics,
+    "get_site_details": _tool_site_details,
+    "batch_site_details": _tool_batch_site_details
+}
+
+def _gsc_service():
+    """GSC service del worker, o errore se l'inizializzazione all'avvio è fallita"""
+    gsc_service = app.state.gsc
+    if not gsc_service:
+        raise Exception(f"GSC service non disponibile: {app.state.gsc_error}")
+    return gsc_service
+
+def _tool_error(tool_name: str, error: Exception) -> Dict[str, Any]:
+    logger.error(f"Errore esecuzione tool {tool_name}: {str(error)}")
+    return {
+        "success": False,
+        "error": str(error),
+        "tool": tool_name
+    }
+
+async def execute_tool(tool_name: str, arguments: Dict[str, Any]) -> Dict[str, Any]:
+    """Esegue un tool specifico"""
+    try:
+        gsc_service = _gsc_service()
+
+        handler = _TOOL_HANDLERS.get(tool_name)
+        if handler is None:
             raise ValueError(f"Tool sconosciuto: {tool_name}")
 
+        return await handler(gsc_service, arguments)
+
     except Exception as e:
-        logger.error(f"Errore esecuzione tool {tool_name}: {str(e)}")
-        return {
-            "success": False,
-            "error": str(e),
-            "tool": tool_name
-        }
+        return _tool_error(tool_name, e)
 
 @app.get("/")
 async def root():
@@ -166,12 +590,15 @@ async def root():
         "name": "Google Search Console MCP Server",
         "version": "1.0.0",
         "status": "running",
-        "gsc_connected": gsc_service is not None,
-        "gsc_error": gsc_error,
+        "gsc_connected": app.state.gsc is not None,
+        "gsc_error": app.state.gsc_error,
         "endpoints": {
             "mcp_sse": "/sse",
+            "mcp_stream": "/sse/tools/call",
+            "mcp_batch": "/mcp/batch",
             "health": "/health",
-            "test": "/test-credentials"
+            "test": "/test-credentials",
+            "cache_clear": "/cache/clear"
         },
         "tools_available": len(TOOLS_DEFINITION)
     }
@@ -181,22 +608,56 @@ async def health_check():
     """Health check"""
     return {
         "status": "healthy",
-        "gsc_service": "connected" if gsc_service else "error",
-        "timestamp": "2024-06-09T12:00:00Z"
+        "gsc_service": "connected" if app.state.gsc else "error",
+        "sse_connections": len(_active_sse),
+        "timestamp": _utc_timestamp()
+    }
+
+@app.post("/cache/clear")
+async def clear_cache():
+    """Svuota la cache di proprietà e dettagli sito e, se configurata, quella analytics su Redis"""
+    cleared = len(_CACHE)
+    _CACHE.clear()
+
+    redis_cleared = 0
+    redis = app.state.redis
+    if redis is not None:
+        try:
+            keys = []
+            async for key in redis.scan_iter(match="gsc:sa:*", count=500):
+                keys.append(key)
+                if len(keys) >= 500:
+                    redis_cleared += await redis.delete(*keys)
+                    keys = []
+            if keys:
+                redis_cleared += await redis.delete(*keys)
+        except RedisError as e:
+            logger.warning(f"Errore svuotamento cache Redis: {e}")
+            return {
+                "status": "error",
+                "cleared": cleared,
+                "redis_cleared": redis_cleared,
+                "error": str(e)
+            }
+
+    return {
+        "status": "success",
+        "cleared": cleared,
+        "redis_cleared": redis_cleared
     }
 
 @app.get("/test-credentials")
 async def test_credentials():
     """Test delle credenziali GSC"""
     try:
+        gsc_service = app.state.gsc
         if not gsc_service:
             return {
                 "status": "error",
-                "message": f"GSC service non inizializzato: {gsc_error}"
+                "message": f"GSC service non inizializzato: {app.state.gsc_error}"
             }
 
-        sites = gsc_service.sites().list().execute()
-        properties = [site['siteUrl'] for site in sites.get('siteEntry', [])]
+        properties = await get_properties(gsc_service)
 
         return {
             "status": "success",
@@ -211,147 +672,310 @@ async def test_credentials():
             "message": f"Errore test credenziali: {str(e)}"
         }
 
+def _utc_timestamp() -> str:
+    """Ora corrente UTC in formato ISO 8601 (es: 2024-06-09T12:00:00Z)"""
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def _sse_frame(payload: Dict[str, Any]) -> bytes:
+    """Serializza un messaggio come frame SSE"""
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+# Frame statici inviati a ogni nuova connessione SSE, serializzati una sola volta
+_CONNECT_FRAME = b"event: connect\n" + _sse_frame({'type': 'connection', 'status': 'connected'})
+_SERVER_INFO_FRAME = _sse_frame({
+    "jsonrpc": "2.0",
+    "method": "server/info",
+    "params": {
+        "name": "gsc-mcp-server",
+        "version": "1.0.0",
+        "capabilities": {
+            "tools": True
+        }
+    }
+})
+_TOOLS_FRAME = _sse_frame({
+    "jsonrpc": "2.0",
+    "method": "tools/list",
+    "params": {
+        "tools": TOOLS_DEFINITION
+    }
+})
+
+class HeartbeatBroadcaster:
+    """Un solo task serializza l'heartbeat a ogni tick e lo condivide con tutti i client SSE"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._next: Optional[asyncio.Future] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._next = asyncio.get_running_loop().create_future()
+            self._task = asyncio.create_task(self._tick())
+
+    async def _tick(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            heartbeat = {
+                "type": "heartbeat",
+                "timestamp": _utc_timestamp()
+            }
+            frame = _sse_frame(heartbeat)
+            current, self._next = self._next, loop.create_future()
+            current.set_result(frame)
+            await asyncio.sleep(self.interval)
+
+    async def wait(self) -> bytes:
+        """Attende il prossimo tick e restituisce il frame già serializzato"""
+        self._ensure_started()
+        return await asyncio.shield(self._next)
+
+    def close(self):
+        """Ferma il task produttore (allo shutdown del worker)"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+# Heartbeat ogni 30 secondi, condiviso tra tutte le connessioni
+_heartbeat = HeartbeatBroadcaster(30)
+
+@app.on_event("shutdown")
+async def _stop_heartbeat():
+    _heartbeat.close()
+
+# Connessioni SSE attive, per id di connessione, con limite massimo per worker
+_active_sse = set()
+_MAX_SSE_CLIENTS = int(os.getenv("GSC_MAX_SSE_CLIENTS", "1000"))
+
+@contextlib.contextmanager
+def _sse_session():
+    """Registra una connessione SSE e la rimuove sempre all'uscita, anche se cancellata"""
+    connection_id = str(uuid.uuid4())
+    _active_sse.add(connection_id)
+    try:
+        yield connection_id
+    finally:
+        _active_sse.discard(connection_id)
+
 @app.get("/sse")
 async def mcp_sse_endpoint(request: Request):
     """Endpoint SSE per protocollo MCP compatibile con n8n"""
-    
+    if len(_active_sse) >= _MAX_SSE_CLIENTS:
+        raise HTTPException(status_code=503, detail="Troppe connessioni SSE attive")
+
     async def generate_sse_stream():
-        # Header SSE
-        yield "event: connect\n"
-        yield f"data: {json.dumps({'type': 'connection', 'status': 'connected'})}\n\n"
-        
-        # Invio informazioni server
-        server_info = {
-            "jsonrpc": "2.0",
-            "method": "server/info",
-            "params": {
-                "name": "gsc-mcp-server",
-                "version": "1.0.0",
-                "capabilities": {
-                    "tools": True
-                }
-            }
-        }
-        yield f"data: {json.dumps(server_info)}\n\n"
-        
-        # Invio lista tool
-        tools_message = {
-            "jsonrpc": "2.0", 
-            "method": "tools/list",
-            "params": {
-                "tools": TOOLS_DEFINITION
-            }
-        }
-        yield f"data: {json.dumps(tools_message)}\n\n"
-        
-        # Mantieni la connessione attiva
-        try:
-            while True:
-                if await request.is_disconnected():
-                    break
-                    
-                # Heartbeat ogni 30 secondi
-                heartbeat = {
-                    "type": "heartbeat",
-                    "timestamp": "2024-06-09T12:00:00Z"
-                }
-                yield f"data: {json.dumps(heartbeat)}\n\n"
-                await asyncio.sleep(30)
-                
-        except asyncio.CancelledError:
-            return
-        except Exception as e:
-            logger.error(f"Errore SSE stream: {e}")
-            yield f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n"
-            return
+        with _sse_session():
+            # Header SSE, informazioni server e lista tool
+            yield _CONNECT_FRAME
+            yield _SERVER_INFO_FRAME
+            yield _TOOLS_FRAME
+
+            # Mantieni la connessione attiva: alla disconnessione del client
+            # StreamingResponse riceve http.disconnect e cancella il generatore,
+            # la cancellazione si propaga e _sse_session() rimuove la connessione
+            try:
+                while True:
+                    yield await _heartbeat.wait()
+            except Exception as e:
+                logger.error(f"Errore SSE stream: {e}")
+                yield _sse_frame({'type': 'error', 'message': str(e)})
 
     return StreamingResponse(
         generate_sse_stream(),
         media_type="text/event-stream",
         headers={
             "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "Access-Control-Allow-Origin": "*",
-            "Access-Control-Allow-Headers": "*",
-            "Access-Control-Allow-Methods": "*"
+            "Connection": "keep-alive"
         }
     )
 
+# Risposta tools/list serializzata una sola volta: per richiesta si codifica solo l'id
+_TOOLS_LIST_PREFIX = b'{"jsonrpc":"2.0","id":'
+_TOOLS_LIST_SUFFIX = b',"result":' + orjson.dumps({"tools": TOOLS_DEFINITION}) + b'}'
+
+def _tools_list_response(msg_id: Any) -> Response:
+    return Response(
+        content=_TOOLS_LIST_PREFIX + orjson.dumps(msg_id) + _TOOLS_LIST_SUFFIX,
+        media_type="application/json"
+    )
+
+def _tool_call_response(msg_id: Any, result: Dict[str, Any], pretty: bool = False) -> Dict[str, Any]:
+    """Risposta JSON-RPC di tools/call con il risultato del tool come testo (indentato solo se pretty)"""
+    option = orjson.OPT_NON_STR_KEYS
+    if pretty:
+        option |= orjson.OPT_INDENT_2
+    return {
+        "jsonrpc": "2.0",
+        "id": msg_id,
+        "result": {
+            "content": [
+                {
+                    "type": "text",
+                    "text": orjson.dumps(result, option=option).decode()
+                }
+            ]
+        }
+    }
+
+async def _mcp_initialize(msg_id: Any, params: Dict[str, Any], pretty: bool):
+    return {
+        "jsonrpc": "2.0",
+        "id": msg_id,
+        "result": {
+            "protocolVersion": "2024-11-05",
+            "capabilities": {
+                "tools": {}
+            },
+            "serverInfo": {
+                "name": "gsc-mcp-server",
+                "version": "1.0.0"
+            }
+        }
+    }
+
+async def _mcp_tools_list(msg_id: Any, params: Dict[str, Any], pretty: bool):
+    return _tools_list_response(msg_id)
+
+async def _mcp_tools_call(msg_id: Any, params: Dict[str, Any], pretty: bool):
+    tool_name = params.get("name")
+    arguments = params.get("arguments", {})
+
+    result = await execute_tool(tool_name, arguments)
+
+    return _tool_call_response(msg_id, result, pretty)
+
+def _method_not_found(msg_id: Any, method: str) -> Dict[str, Any]:
+    return {
+        "jsonrpc": "2.0",
+        "id": msg_id,
+        "error": {
+            "code": -32601,
+            "message": f"Metodo non trovato: {method}"
+        }
+    }
+
+# Dispatch dei metodi MCP: metodo -> handler
+_MCP_HANDLERS = {
+    "initialize": _mcp_initialize,
+    "tools/list": _mcp_tools_list,
+    "tools/call": _mcp_tools_call
+}
+
 @app.post("/sse")
-async def handle_mcp_message(message: Dict[str, Any]):
+async def handle_mcp_message(message: MCPMessage, pretty: bool = False):
     """Gestisce messaggi MCP via POST"""
     try:
-        method = message.get("method")
-        params = message.get("params", {})
-        msg_id = message.get("id", "1")
+        method = message.method
+        msg_id = message.id
         
         logger.info(f"Ricevuto messaggio MCP: {method}")
         
-        if method == "initialize":
-            return {
-                "jsonrpc": "2.0",
-                "id": msg_id,
-                "result": {
-                    "protocolVersion": "2024-11-05",
-                    "capabilities": {
-                        "tools": {}
-                    },
-                    "serverInfo": {
-                        "name": "gsc-mcp-server",
-                        "version": "1.0.0"
-                    }
-                }
-            }
-            
-        elif method == "tools/list":
-            return {
-                "jsonrpc": "2.0",
-                "id": msg_id,
-                "result": {
-                    "tools": TOOLS_DEFINITION
-                }
-            }
-            
-        elif method == "tools/call":
-            tool_name = params.get("name")
-            arguments = params.get("arguments", {})
-            
-            result = execute_tool(tool_name, arguments)
-            
-            return {
-                "jsonrpc": "2.0",
-                "id": msg_id,
-                "result": {
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": json.dumps(result, indent=2, ensure_ascii=False)
-                        }
-                    ]
-                }
-            }
-            
-        else:
-            return {
-                "jsonrpc": "2.0",
-                "id": msg_id,
-                "error": {
-                    "code": -32601,
-                    "message": f"Metodo non trovato: {method}"
-                }
-            }
+        handler = _MCP_HANDLERS.get(method)
+        if handler is None:
+            return _method_not_found(msg_id, method)
+
+        return await handler(msg_id, message.params, pretty)
             
     except Exception as e:
         logger.error(f"Errore gestione messaggio MCP: {e}")
         return {
             "jsonrpc": "2.0",
-            "id": message.get("id", "1"),
+            "id": message.id,
             "error": {
                 "code": -32000,
                 "message": str(e)
             }
         }
 
+async def _batch_item(raw: Any):
+    """Valida un singolo elemento del batch: se non è valido risponde -32600 solo per quello"""
+    try:
+        message = MCPMessage.model_validate(raw)
+    except ValidationError as e:
+        msg_id = raw.get("id") if isinstance(raw, dict) else None
+        if not isinstance(msg_id, (str, int)) or (
+            isinstance(msg_id, int) and not _ID_MIN <= msg_id <= _ID_MAX
+        ):
+            msg_id = None
+        return {
+            "jsonrpc": "2.0",
+            "id": msg_id,
+            "error": {
+                "code": -32600,
+                "message": "Richiesta non valida: " + "; ".join(
+                    f"{'.'.join(map(str, err['loc'])) or 'body'}: {err['msg']}" for err in e.errors()
+                )
+            }
+        }
+    return await handle_mcp_message(message)
+
+@app.post("/mcp/batch")
+async def batch_mcp_endpoint(messages: List[Any]):
+    """Gestisce una lista di messaggi MCP in parallelo, restituendo le risposte nello stesso ordine"""
+    # Le chiamate a Google restano limitate da quota e concorrenza adattiva in _run()
+    responses = await asyncio.gather(*(_batch_item(m) for m in messages))
+    # Le risposte già serializzate (tools/list) vengono concatenate così come sono
+    return Response(
+        content=b"[" + b",".join(
+            r.body if isinstance(r, Response) else orjson.dumps(r) for r in responses
+        ) + b"]",
+        media_type="application/json"
+    )
+
+@app.post("/sse/tools/call")
+async def stream_tool_call(message: MCPMessage, pretty: bool = False):
+    """Esegue tools/call in streaming: le pagine searchAnalytics arrivano come eventi SSE"""
+    params = message.params
+    msg_id = message.id
+    if message.method != "tools/call":
+        return _method_not_found(msg_id, message.method)
+
+    tool_name = params.get("name")
+    arguments = params.get("arguments", {})
+
+    async def generate_tool_stream():
+        if tool_name != "get_search_analytics":
+            result = await execute_tool(tool_name, arguments)
+        else:
+            try:
+                gsc_service = _gsc_service()
+
+                sa_params = SearchAnalyticsParams.model_validate(arguments)
+                start_date = sa_params.start_date.isoformat()
+                end_date = sa_params.end_date.isoformat()
+
+                summary = _AnalyticsSummary(sa_params.site_url, start_date, end_date)
+                async for rows in _iter_search_analytics(
+                    gsc_service, sa_params.site_url, start_date, end_date, sa_params.max_rows
+                ):
+                    summary.add_page(rows)
+
+                    # Ogni pagina viene inviata appena ricevuta da Google
+                    yield _sse_frame({
+                        "jsonrpc": "2.0",
+                        "method": "tools/progress",
+                        "params": {
+                            "id": msg_id,
+                            "progress": summary.total_queries,
+                            "rows": rows
+                        }
+                    })
+
+                result = summary.result()
+            except Exception as e:
+                result = _tool_error(tool_name, e)
+
+        yield b"event: done\n" + _sse_frame(_tool_call_response(msg_id, result, pretty))
+
+    return StreamingResponse(
+        generate_tool_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache"
+        }
+    )
+
 # Endpoint legacy per compatibilità
 @app.post("/mcp")
 async def legacy_mcp_endpoint(request: Dict[str, Any]):
@@ -360,14 +984,11 @@ async def legacy_mcp_endpoint(request: Dict[str, Any]):
         method = request.get("method")
         params = request.get("params", {})
         
-        if method == "list_properties":
-            result = execute_tool("list_properties", {})
-        elif method == "get_search_analytics":
-            result = execute_tool("get_search_analytics", params)
-        elif method == "get_site_details":
-            result = execute_tool("get_site_details", params)
-        else:
+        # I metodi legacy coincidono con i nomi dei tool
+        if method not in _TOOL_HANDLERS:
             raise ValueError(f"Metodo non supportato: {method}")
+
+        result = await execute_tool(method, params)
             
         return {"result": result}
         
@@ -377,5 +998,28 @@ async def legacy_mcp_endpoint(request: Dict[str, Any]):
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8000))
     logger.info(f"🚀 Starting GSC MCP Server on port {port}")
-    logger.info(f"📊 GSC Service Status: {'✅ Connected' if gsc_service else '❌ Error'}")
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # Nei container cpu_count() riporta spesso le CPU dell'host: il default resta contenuto
+    workers = int(os.environ.get("WEB_CONCURRENCY", min(os.cpu_count() or 1, 4)))
+    logger.info(f"👷 Workers: {workers}")
+    # Ereditato dai processi worker, che dividono GSC_RPM_LIMIT per questo valore
+    os.environ["GSC_WORKERS"] = str(workers)
+
+    # uvloop non è disponibile su Windows: in quel caso resta il loop asyncio
+    try:
+        import uvloop  # noqa: F401
+        loop = "uvloop"
+    except ImportError:
+        loop = "asyncio"
+    logger.info(f"🔁 Event loop: {loop}")
+
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        workers=workers,
+        loop=loop,
+        http="httptools",
+        log_level="info",
+        # Le connessioni SSE restano aperte: senza limite lo shutdown attenderebbe per sempre
+        timeout_graceful_shutdown=int(os.environ.get("GRACEFUL_SHUTDOWN_TIMEOUT", 10))
+    )